@@ -1,10 +1,26 @@
-import json
-from datetime import datetime
-from dateutil import parser
+import contextlib
+import functools
+import hashlib
+import itertools
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import boto3
+from botocore.config import Config
 import streamlit as st
 import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from streamlit_autorefresh import st_autorefresh
 
 # --------------------------------------------------
@@ -18,16 +34,45 @@ MAP_NAME = st.secrets.get("MAP_NAME", "")
 PLACE_INDEX = st.secrets.get("PLACE_INDEX", "")
 ROUTE_CALCULATOR = st.secrets.get("ROUTE_CALCULATOR", "")
 TICKETMASTER_KEY = st.secrets.get("TICKETMASTER_API_KEY", "")
+CACHE_PATH = st.secrets.get("CACHE_PATH", ".cache/monmaps.sqlite3")
+
+# Script-level globals are rebuilt on every rerun, so keep the clients (and their
+# connection pools) in st.cache_resource
+@st.cache_resource
+def get_location_client():
+    """boto3 client for Amazon Location, shared across reruns and threads"""
+    return boto3.client(
+        "location",
+        region_name=AWS_REGION,
+        # Enough pooled connections for the concurrent keyword fan-out; "adaptive"
+        # retries add a client-side token bucket that only throttles real requests
+        config=Config(max_pool_connections=16, retries={"max_attempts": 3, "mode": "adaptive"}),
+    )
+
+@st.cache_resource
+def get_http_session():
+    """Shared HTTP session: keeps TCP/TLS connections alive between API calls"""
+    session = requests.Session()
+    session.headers["User-Agent"] = "monmaps-app"
+    adapter = HTTPAdapter(
+        pool_connections=20, pool_maxsize=50,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-# Create boto3 client for Amazon Location
 try:
-    location_client = boto3.client("location", region_name=AWS_REGION)
+    location_client = get_location_client()
 except Exception as e:
     st.error(f"❌ Could not initialize AWS Location client. Error: {e}")
     st.stop()
 
+SESSION = get_http_session()
+
 refresh_interval = st.sidebar.slider("Auto-refresh interval (minutes)", 1, 30, 5)
-st_autorefresh(interval=refresh_interval * 60 * 1000, key="auto_refresh")
+# Counts auto-refresh ticks; part of the fetch fingerprint so every tick refetches
+refresh_count = st_autorefresh(interval=refresh_interval * 60 * 1000, key="auto_refresh")
 
 # --------------------------------------------------
 # UTILITIES
@@ -37,72 +82,216 @@ TRAINING_KEYWORDS = [
     "institute", "skill development", "Data Science", "Python"
 ]
 
+@st.cache_resource
+def _init_disk_cache():
+    """Create the SQLite response cache once per process"""
+    os.makedirs(os.path.dirname(CACHE_PATH) or ".", exist_ok=True)
+    with contextlib.closing(sqlite3.connect(CACHE_PATH)) as conn, conn:
+        # WAL lets readers in other threads/processes proceed while a result is written
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+        conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+    return CACHE_PATH
+
+DISK_CACHE_SWEEP_EVERY = 100
+
+@st.cache_resource
+def _disk_cache_writes():
+    """Process-wide write counter that triggers the periodic expired-row sweep"""
+    return itertools.count(1)
+
+@st.cache_resource
+def _code_version():
+    """Hash of this file, so a deploy that changes fetch/parse code starts from a clean cache"""
+    with open(__file__, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+
+def disk_cached(ttl):
+    """Persist a function's results in SQLite for ttl seconds, so restarts start warm.
+
+    The cache is best-effort: any SQLite error or unreadable row is treated as a miss.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args):
+            key = hashlib.blake2b(repr((_code_version(), fn.__name__, args)).encode(),
+                                  digest_size=16).hexdigest()
+            try:
+                with contextlib.closing(sqlite3.connect(_init_disk_cache())) as conn:
+                    row = conn.execute("SELECT value FROM cache WHERE key = ? AND expires > ?",
+                                       (key, time.time())).fetchone()
+            except (sqlite3.Error, OSError):
+                row = None
+            if row:
+                try:
+                    return pickle.loads(zlib.decompress(row[0]))
+                except Exception:
+                    # Corrupt or no longer unpicklable (EOFError, AttributeError, ImportError...):
+                    # drop the row so it isn't retried until it expires
+                    try:
+                        with contextlib.closing(sqlite3.connect(_init_disk_cache())) as conn, conn:
+                            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    except (sqlite3.Error, OSError):
+                        pass
+            result = fn(*args)
+            try:
+                with contextlib.closing(sqlite3.connect(_init_disk_cache())) as conn, conn:
+                    conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                                 (key, zlib.compress(pickle.dumps(result)), time.time() + ttl))
+                    # Long-running servers rarely restart, so also sweep every N writes
+                    if next(_disk_cache_writes()) % DISK_CACHE_SWEEP_EVERY == 0:
+                        conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+            except (sqlite3.Error, OSError):
+                pass
+            return result
+        return wrapper
+    return decorator
+
+def clear_disk_cache():
+    """Drop every persisted response"""
+    try:
+        with contextlib.closing(sqlite3.connect(_init_disk_cache())) as conn, conn:
+            conn.execute("DELETE FROM cache")
+    except (sqlite3.Error, OSError):
+        pass
+
+@st.cache_data(ttl=6 * 60 * 60, show_spinner=False)
+@disk_cached(ttl=6 * 60 * 60)
+def _search_place_index(text, lat, lng, max_results):
+    """Cached Place Index lookup; errors propagate so they are never cached"""
+    response = location_client.search_place_index_for_text(
+        IndexName=PLACE_INDEX,
+        Text=text,
+        BiasPosition=[lng, lat],
+        MaxResults=max_results
+    )
+    places = []
+    for item in response.get("Results", []):
+        place = item.get("Place", {})
+        pos = place.get("Geometry", {}).get("Point", [])
+        if len(pos) == 2:
+            places.append({
+                "id": item.get("PlaceId"),
+                "name": place.get("Label", "Unnamed"),
+                "address": place.get("AddressNumber", "") + " " + place.get("Street", ""),
+                "lat": pos[1],
+                "lng": pos[0]
+            })
+    return places
+
 def fetch_aws_places(text, lat, lng, max_results=50):
-    """Query AWS Location Place Index using boto3 (Signature V4)"""
+    """Query AWS Location Place Index using boto3 (Signature V4); None on error"""
     try:
-        response = location_client.search_place_index_for_text(
-            IndexName=PLACE_INDEX,
-            Text=text,
-            BiasPosition=[lng, lat],
-            MaxResults=max_results
-        )
-        places = []
-        for item in response.get("Results", []):
-            place = item.get("Place", {})
-            pos = place.get("Geometry", {}).get("Point", [])
-            if len(pos) == 2:
-                places.append({
-                    "name": place.get("Label", "Unnamed"),
-                    "address": place.get("AddressNumber", "") + " " + place.get("Street", ""),
-                    "lat": pos[1],
-                    "lng": pos[0]
-                })
-        return places
+        # Round the bias point (~100 m) so small moves still hit the cache
+        return _search_place_index(text, round(lat, 3), round(lng, 3), max_results)
     except Exception as e:
         st.warning(f"⚠️ AWS Places error: {e}")
-        return []
+        return None
 
-def fetch_ticketmaster_events(city, max_results=20):
-    """Fetch events from Ticketmaster API"""
-    if not TICKETMASTER_KEY:
-        st.warning("⚠️ No Ticketmaster API key found.")
-        return []
+TICKETMASTER_ETAG_SLOTS = 128
+
+@st.cache_resource
+def _ticketmaster_etags():
+    """(city, on_date, max_results) -> (ETag, parsed result) of recent Ticketmaster responses.
+
+    Kept as an LRU capped at TICKETMASTER_ETAG_SLOTS entries, guarded by a lock.
+    """
+    return OrderedDict(), threading.Lock()
+
+@st.cache_data(ttl=5 * 60, show_spinner=False)
+@disk_cached(ttl=5 * 60)
+def _ticketmaster_events(city, on_date, max_results):
+    """Cached Ticketmaster Discovery query -> (events, raw response when nothing matched)"""
     url = "https://app.ticketmaster.com/discovery/v2/events.json"
     params = {"apikey": TICKETMASTER_KEY, "city": city, "size": max_results, "sort": "date,asc"}
-    try:
-        r = requests.get(url, params=params, timeout=10)
-        data = r.json()
+    if on_date:
+        # Let Ticketmaster filter by day instead of downloading events we'd drop; the
+        # window is in venue-local time so it matches the localDate the user picked
+        params["localStartDateTime"] = f"{on_date}T00:00:00,{on_date}T23:59:59"
+    etags, lock = _ticketmaster_etags()
+    key = (city, on_date, max_results)
+    with lock:
+        previous = etags.get(key)
+        if previous:
+            etags.move_to_end(key)
+    headers = {"If-None-Match": previous[0]} if previous else None
+    r = SESSION.get(url, params=params, headers=headers, timeout=10)
+    if r.status_code == 304 and previous:
+        return previous[1]
+    # Surface 4xx/5xx as an error (and keep it out of the cache) without decoding the body
+    r.raise_for_status()
+    result = _parse_ticketmaster(orjson.loads(r.content))
+    if r.headers.get("ETag"):
+        with lock:
+            etags[key] = (r.headers["ETag"], result)
+            etags.move_to_end(key)
+            while len(etags) > TICKETMASTER_ETAG_SLOTS:
+                etags.popitem(last=False)
+    return result
 
-        if "_embedded" not in data:
-            st.info(f"ℹ️ No Ticketmaster events found for {city}. Raw response:\n{data}")
-            return []
+def _parse_ticketmaster(data):
+    """Discovery API payload -> (events, raw response when nothing matched)"""
+    if "_embedded" not in data:
+        return [], data
 
-        events = []
-        for ev in data["_embedded"]["events"]:
-            ev_date = None
-            if ev.get("dates", {}).get("start", {}).get("localDate"):
-                try:
-                    ev_date = parser.parse(ev["dates"]["start"]["localDate"]).date()
-                except:
-                    pass
-            venues = ev.get("_embedded", {}).get("venues", [])
-            lat, lng = None, None
-            if venues and venues[0].get("location"):
-                lat = float(venues[0]["location"]["latitude"])
-                lng = float(venues[0]["location"]["longitude"])
-            events.append({
-                "name": ev.get("name"),
-                "description": ev.get("info", "") or ev.get("pleaseNote", ""),
-                "link": ev.get("url", ""),
-                "date": ev_date,
-                "venue": venues[0].get("name") if venues else "",
-                "lat": lat,
-                "lng": lng
-            })
+    events = []
+    for ev in data["_embedded"]["events"]:
+        ev_date = None
+        if ev.get("dates", {}).get("start", {}).get("localDate"):
+            try:
+                # localDate is always ISO YYYY-MM-DD
+                ev_date = date.fromisoformat(ev["dates"]["start"]["localDate"])
+            except ValueError:
+                pass
+        venues = ev.get("_embedded", {}).get("venues", [])
+        lat, lng = None, None
+        if venues and venues[0].get("location"):
+            lat = float(venues[0]["location"]["latitude"])
+            lng = float(venues[0]["location"]["longitude"])
+        events.append({
+            "name": ev.get("name"),
+            "description": ev.get("info", "") or ev.get("pleaseNote", ""),
+            "link": ev.get("url", ""),
+            "date": ev_date,
+            "venue": venues[0].get("name") if venues else "",
+            "lat": lat,
+            "lng": lng
+        })
+    return events, None
+
+def fetch_ticketmaster_events(city, on_date=None, max_results=20):
+    """Fetch events from Ticketmaster API; [] when no key is configured, None on error"""
+    if not TICKETMASTER_KEY:
+        # Not configured is permanent, not a failed fetch; the warning is shown with the event list
+        return []
+    try:
+        # "Mumbai" and " mumbai" are the same Ticketmaster query
+        events, raw = _ticketmaster_events(city.strip().lower(), on_date, max_results)
+        if raw is not None:
+            st.info(f"ℹ️ No Ticketmaster events found for {city}. Raw response:\n{raw}")
         return events
+    except requests.HTTPError as e:
+        # str(e) includes the request URL, and with it the API key
+        st.warning(f"⚠️ Ticketmaster error: {e.response.status_code} {e.response.reason}")
+        return None
     except Exception as e:
-        st.warning(f"⚠️ Ticketmaster error: {e}")
+        # RetryError/ConnectionError messages quote the URL too; drop its query string
+        message = re.sub(r"\?\S*", "?…", str(e))
+        st.warning(f"⚠️ Ticketmaster error: {message}")
+        return None
+
+def thread_pool(max_workers):
+    """ThreadPoolExecutor whose workers share this run's Streamlit context (so st.* calls still render)"""
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(max_workers=max_workers,
+                              initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+
+def run_parallel(fn, items, max_workers=16):
+    """Map fn over items on a thread pool, keeping input order"""
+    if not items:
         return []
+    with thread_pool(min(max_workers, len(items))) as ex:
+        return list(ex.map(fn, items))
 
 def fetch_route(start_lat, start_lng, end_lat, end_lng):
     """Fetch driving route using AWS SDK (optional)"""
@@ -132,9 +321,19 @@ with st.sidebar.expander("🔍 Search by City / Area", expanded=True):
         st.session_state.location = {"lat": lat_input, "lng": lng_input, "city": city_input}
         st.success(f"✅ Location updated to {city_input}")
 
-radius_km = st.sidebar.slider("Radius (km)", 1, 15, 5)
-selected_kw = st.sidebar.multiselect("Search Keywords", TRAINING_KEYWORDS, default=["Data Science", "Python"])
-date_filter = st.sidebar.date_input("Filter by Event Date", value=None)
+# Widgets in a form only take effect on "Apply", so dragging a slider doesn't refetch
+with st.sidebar.form("filters"):
+    radius_km = st.slider("Radius (km)", 1, 15, 5)
+    selected_kw = st.multiselect("Search Keywords", TRAINING_KEYWORDS, default=["Data Science", "Python"])
+    date_filter = st.date_input("Filter by Event Date", value=None)
+    max_places = st.slider("Max places", 50, 500, 150)
+    st.form_submit_button("Apply")
+
+if st.sidebar.button("🔄 Force refresh"):
+    _search_place_index.clear()
+    _ticketmaster_events.clear()
+    clear_disk_cache()
+    st.session_state.pop("last_fetch", None)
 
 # --------------------------------------------------
 # FETCH DATA
@@ -146,66 +345,118 @@ city = st.session_state.location["city"]
 st.title("🗺️ MonMaps — Nearby Training & Events (AWS + Ticketmaster)")
 st.caption("Powered by Amazon Location Service (HERE) + Ticketmaster")
 
-with st.spinner("🔎 Searching AWS Places..."):
-    results = []
-    for kw in selected_kw:
-        results.extend(fetch_aws_places(kw, lat, lng))
+def fetch_all(lat, lng, city, keywords, on_date, max_places):
+    """Run the AWS keyword searches and the Ticketmaster query -> (places, events, ok); ok is False if any failed"""
+    # Ticketmaster does not depend on the place searches, so fetch it alongside them
+    with thread_pool(1) as bg:
+        events_future = bg.submit(fetch_ticketmaster_events, city, on_date)
+
+        # Overlapping keywords return the same place; keep the first hit per PlaceId,
+        # or per rounded position + name for indexes that don't return PlaceIds
+        results, seen, ok = [], set(), True
+        for places in run_parallel(lambda kw: fetch_aws_places(kw, lat, lng), keywords):
+            if places is None:
+                ok = False
+                continue
+            for p in places:
+                key = p["id"] or (round(p["lat"], 5), round(p["lng"], 5), p["name"])
+                if key in seen:
+                    continue
+                seen.add(key)
+                results.append(p)
+                if len(results) >= max_places:
+                    break
+            if len(results) >= max_places:
+                break
 
-with st.spinner("🎫 Fetching Ticketmaster events..."):
-    events = fetch_ticketmaster_events(city)
+        events = events_future.result()
+        if events is None:
+            events, ok = [], False
+        return results, events, ok
+
+# Reruns with the same inputs reuse the last fetch outright; the auto-refresh counter is
+# part of the fingerprint, so each tick fetches again
+fetch_fp = hashlib.blake2b(repr((round(lat, 3), round(lng, 3), tuple(selected_kw),
+                                 city.strip().lower(), date_filter, max_places, refresh_count)).encode(),
+                           digest_size=16).digest()
+last_fetch = st.session_state.get("last_fetch")
+if last_fetch and last_fetch["fp"] == fetch_fp:
+    results, events, fetch_ok = last_fetch["results"], last_fetch["events"], True
+else:
+    with st.spinner("🔎 Searching AWS Places and 🎫 Ticketmaster events..."):
+        results, events, fetch_ok = fetch_all(lat, lng, city, selected_kw, date_filter, max_places)
+    # Don't pin a failed fetch: the next rerun retries and shows the warning again
+    if fetch_ok:
+        st.session_state.last_fetch = {"fp": fetch_fp, "results": results, "events": events}
+    else:
+        st.session_state.pop("last_fetch", None)
 
 st.subheader(f"📍 Found {len(results)} institutes and {len(events)} events in {city}")
 
 # --------------------------------------------------
 # MAP DISPLAY
 # --------------------------------------------------
-MAP_HTML = f"""
-<!DOCTYPE html>
-<html>
-<head>
-<meta charset="utf-8"/>
-<style>html,body,#map{{height:100%;margin:0;padding:0}}</style>
-<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css"/>
-<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
-</head>
-<body>
-<div id="map"></div>
-<script>
-var map = L.map('map').setView([{lat},{lng}], 13);
-L.tileLayer('https://maps.geo.{AWS_REGION}.amazonaws.com/maps/v0/maps/{MAP_NAME}/tiles/{{z}}/{{x}}/{{y}}?key=YOUR_MAP_KEY', {{
-    maxZoom: 18
-}}).addTo(map);
-
-L.marker([{lat},{lng}]).addTo(map).bindPopup("📍 You are here").openPopup();
-var places = {json.dumps(results)};
-places.forEach(p => {{
-  var m = L.marker([p.lat, p.lng]).addTo(map);
-  var html = `<b>${{p.name}}</b><br>${{p.address || ''}}<br>
-  <a href='https://www.google.com/maps?q=${{p.lat}},${{p.lng}}' target='_blank'>Open in Google Maps</a>`;
-  m.bindPopup(html);
-}});
-</script>
-</body></html>
-"""
-components.html(MAP_HTML, height=520, scrolling=False)
+@st.cache_resource
+def load_map_template():
+    """Static Leaflet page (map_template.html); only __CENTER__ and __PLACES__ change per rerun"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "map_template.html"), encoding="utf-8") as f:
+        return f.read().replace("__REGION__", AWS_REGION).replace("__MAP_NAME__", MAP_NAME)
+
+def script_json(obj):
+    """JSON for inlining in a <script> block; escapes "</" so data can't close the tag"""
+    return orjson.dumps(obj).replace(b"</", b"<\\/").decode()
+
+def build_map_html(lat, lng, places):
+    """Fill the static map template with the center point and place markers"""
+    # One array per field instead of one object per marker: the keys are sent once.
+    # 5 decimals (~1 m) is plenty for a pin and roughly halves the coordinate bytes
+    columns = {
+        "name": [p["name"] for p in places],
+        "lat": [round(p["lat"], 5) for p in places],
+        "lng": [round(p["lng"], 5) for p in places],
+        "address": [p["address"].strip() for p in places],
+    }
+    if not any(columns["address"]):
+        del columns["address"]
+    return (load_map_template()
+            .replace("__CENTER__", script_json([lat, lng]))
+            .replace("__PLACES__", script_json(columns)))
+
+# Only rebuild the map page when its inputs change; identical srcdoc keeps the iframe.
+# The fetch fingerprint stands in for the results, so nothing is re-serialised per rerun;
+# a failed fetch has no stable fingerprint and always rebuilds
+map_key = (fetch_fp, lat, lng) if fetch_ok else None
+if map_key is None or st.session_state.get("map_key") != map_key:
+    st.session_state.map_html = build_map_html(lat, lng, results)
+    st.session_state.map_key = map_key
+components.html(st.session_state.map_html, height=520, scrolling=False)
 
 # --------------------------------------------------
 # EVENT LIST
 # --------------------------------------------------
 st.subheader(f"🎟️ Live & Upcoming Events in {city}")
 
-if not events:
+if not TICKETMASTER_KEY:
+    st.warning("⚠️ No Ticketmaster API key found.")
+elif not events:
     st.info("ℹ️ No upcoming events found for this location. Try searching a larger city (e.g., New York, London).")
 else:
     filtered_events = [e for e in events if not date_filter or (e["date"] and e["date"] == date_filter)]
+    cards = []
     for e in filtered_events:
         gmap_url = f"https://www.google.com/maps/search/?api=1&query={e['lat']},{e['lng']}" if e.get("lat") else ""
-        st.markdown(f"""
-        <div style='background:#f9f9ff;padding:15px;border-radius:10px;margin-bottom:10px;border:1px solid #e0e0e0;'>
-        <h4 style='color:#1a73e8;'>{e['name']}</h4>
-        <p>📅 {e['date'] or 'Unspecified'} | 🏛️ {e.get('venue','')}</p>
-        <p>{e.get('description','')}</p>
-        <a href='{e['link']}' target='_blank'>🎫 View Event</a> |
-        <a href='{gmap_url}' target='_blank'>📍 Map</a>
-        </div>
-        """, unsafe_allow_html=True)
+        # A newline in any field would break dedent/Markdown for every card after it
+        name, venue, description = (" ".join(str(v or "").split())
+                                    for v in (e["name"], e.get("venue", ""), e.get("description", "")))
+        # No leading indentation: the cards are joined into one Markdown body
+        cards.append(
+            "<div style='background:#f9f9ff;padding:15px;border-radius:10px;margin-bottom:10px;border:1px solid #e0e0e0;'>\n"
+            f"<h4 style='color:#1a73e8;'>{name}</h4>\n"
+            f"<p>📅 {e['date'] or 'Unspecified'} | 🏛️ {venue}</p>\n"
+            f"<p>{description}</p>\n"
+            f"<a href='{e['link']}' target='_blank'>🎫 View Event</a> |\n"
+            f"<a href='{gmap_url}' target='_blank'>📍 Map</a>\n"
+            "</div>\n"
+        )
+    # One markdown element for the whole list instead of one per event
+    st.markdown("".join(cards), unsafe_allow_html=True)